@@ -1,8 +1,131 @@
 # Developed by Ferhat Mousavi
-from publicsuffix2 import get_sld
+import re
+import sys
+from functools import lru_cache
+from types import ModuleType
+
+from publicsuffix2 import PublicSuffixList
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
 from django.http import HttpResponseNotFound, HttpResponsePermanentRedirect
-from django.urls import path, include
+from django.urls import clear_url_caches, path, include
+
+# Actions of the dispatch table: redirect to a URL, route with a URL configuration, or return a 404.
+_REDIRECT, _URLCONF, _NOT_FOUND = range(3)
+
+# Number of default subdomain parameter names (subdomain1, subdomain2, etc.) prepared in advance.
+_DEFAULT_SUBDOMAIN_NAMES = 8
+
+# Load the Public Suffix List at import time, so the first request does not pay for it.
+_PSL = PublicSuffixList()
+
+
+class _DomainTrie:
+    """
+    A trie of domain names keyed on their labels in reverse order
+    (e.g., example.com is stored under 'com' -> 'example').
+    Each node holds its child nodes and, if a domain ends at it, that domain's name.
+    """
+
+    __slots__ = ('children', 'domain')
+
+    def __init__(self, domains=()):
+        self.children = {}
+        self.domain = None
+
+        for domain in domains:
+            self.insert(domain)
+
+    def insert(self, domain):
+        """
+        Adds a domain to the trie, creating the nodes for its labels as needed.
+        """
+        node = self
+        for label in reversed(domain.split('.')):
+            node = node.children.setdefault(label, _DomainTrie())
+        # Configured domains are interned once here; hosts from requests are never interned,
+        # since interned strings may outlive the cache entries that refer to them.
+        node.domain = sys.intern(domain)
+
+
+def _lower_case_domains(config, setting_name):
+    """
+    Returns a copy of a domain-keyed setting with its domains lower-cased, since host names
+    are case-insensitive. Raises ImproperlyConfigured if two domains differ only by case,
+    as one of them would otherwise be silently ignored.
+    """
+    lower_case_config = {}
+    for domain, value in (config or {}).items():
+        lower_case_domain = domain.lower()
+        if lower_case_domain in lower_case_config:
+            raise ImproperlyConfigured(
+                f"{setting_name} contains the domain '{lower_case_domain}' more than once "
+                f"(domain names are case-insensitive)."
+            )
+        lower_case_config[lower_case_domain] = value
+    return lower_case_config
+
+
+def _urlconf_module_name(domain=None):
+    """
+    Returns the name under which the combined URL configuration of a domain is registered in
+    sys.modules, or that of the fallback configuration if no domain is given.
+    Every character other than a letter or digit is escaped as _<hex code>_, so different
+    domains never share a name.
+    """
+    if domain is None:
+        return '_dj_multidomain_fallback'
+
+    escaped_domain = re.sub(r'[^A-Za-z0-9]', lambda match: f'_{ord(match.group()):x}_', domain)
+    return f'_dj_multidomain_host_{escaped_domain}'
+
+
+@lru_cache(maxsize=1024)
+def _parse_host(host_header, known_domains=None):
+    """
+    Splits a raw Host header into its base domain and subdomains.
+    - known_domains: A _DomainTrie of the configured domains. A host matching one or more of
+      them is split at the longest (most specific) one; any other host falls back to the
+      Public Suffix List.
+    The set of distinct hosts a site sees is small, so results are memoized
+    and returned as tuples so that the cached value can be shared safely.
+    """
+
+    # Extract the host name (excluding the port number, if present).
+    # Host names are case-insensitive, so the host is lower-cased to match the configured domains.
+    host = host_header.partition(':')[0].lower()
+
+    # Split the full host into parts (e.g., subdomain.domain.com -> [subdomain, domain, com]).
+    domain_parts = host.split('.')
+
+    # Walk the trie from the rightmost label, remembering the deepest configured domain that
+    # matches, so that e.g. blog.example.com takes precedence over example.com.
+    node = known_domains
+    matched_domain, matched_size = None, 0
+    if node is not None:
+        for size, label in enumerate(reversed(domain_parts), 1):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.domain:
+                matched_domain, matched_size = node.domain, size
+
+    if matched_domain:
+        return matched_domain, tuple(domain_parts[:-matched_size])
+
+    # Get the second-level domain (SLD) using the public suffix list.
+    sld = _PSL.get_sld(host)
+
+    if sld:
+        # Determine the subdomains by excluding the SLD parts from the full host.
+        subdomains = tuple(domain_parts[: -(sld.count('.') + 1)])
+    else:
+        # If get_sld fails, assume the entire host is the domain and there are no subdomains.
+        sld = host
+        subdomains = ()
+
+    # Return the base domain (SLD) and the subdomains.
+    return sld, subdomains
 
 
 class MultipleDomainMiddleware:
@@ -13,6 +136,14 @@ class MultipleDomainMiddleware:
     from certain domains to others and allows for fallback handling in DEBUG mode.
     """
 
+    # The attributes are read on every request; slots make those reads cheaper than a __dict__ lookup.
+    __slots__ = (
+        'get_response', 'url_config', 'redirect_config', 'subdomain_config',
+        '_use_x_forwarded_host', '_common_urls', '_default_domain', '_debug', '_subdomain_names',
+        '_urlconf_by_host', '_fallback_urlconf', '_redirect_urls', '_dispatch', '_fallback',
+        '_domain_trie',
+    )
+
     def __init__(self, get_response):
         """
         Initializes the middleware.
@@ -23,12 +154,45 @@ class MultipleDomainMiddleware:
         - redirect_config: Retrieves the MULTI_REDIRECT_CONFIG setting, which maps domains
           that should be automatically redirected to other domains.
         - subdomain_config: Retrieves the MULTI_SUBDOMAIN_CONFIG setting to manage subdomain mappings.
+        - _use_x_forwarded_host: Retrieves the USE_X_FORWARDED_HOST setting, which makes the
+          X-Forwarded-Host header take precedence over the Host header.
+        - _common_urls / _default_domain / _debug: The COMMON_URLS, DEFAULT_DOMAIN and DEBUG
+          settings, read once rather than through the lazy settings object on every use.
+        - _urlconf_by_host / _fallback_urlconf: The combined URL configurations, built once
+          here since the settings they are derived from do not change at runtime.
+        - _subdomain_names: The attribute names used for the subdomains, in order. Custom names
+          from MULTI_SUBDOMAIN_CONFIG come first, followed by a fixed number of default names.
+        - _redirect_urls: The redirect target URL for each domain in MULTI_REDIRECT_CONFIG.
+        - _dispatch / _fallback: The action and its payload for every configured domain, and for
+          any other domain, so that each request is routed with a single lookup.
+        - _domain_trie: The domains of MULTI_DOMAIN_CONFIG and MULTI_REDIRECT_CONFIG as a trie of
+          reversed labels, used to match request hosts without consulting the Public Suffix List.
         """
         self.get_response = get_response
         self.url_config = getattr(settings, 'MULTI_DOMAIN_CONFIG', None)
         self.redirect_config = getattr(settings, 'MULTI_REDIRECT_CONFIG', None)
         self.subdomain_config = getattr(settings, 'MULTI_SUBDOMAIN_CONFIG', None)
 
+        # If neither MULTI_DOMAIN_CONFIG nor MULTI_REDIRECT_CONFIG is defined, there is nothing
+        # to route or redirect, so ask Django to remove this middleware from the chain.
+        if not self.url_config and not self.redirect_config:
+            raise MiddlewareNotUsed('MULTI_DOMAIN_CONFIG and MULTI_REDIRECT_CONFIG are not defined.')
+
+        self._use_x_forwarded_host = getattr(settings, 'USE_X_FORWARDED_HOST', False)
+        self._common_urls = getattr(settings, 'COMMON_URLS', None)
+        self._default_domain = getattr(settings, 'DEFAULT_DOMAIN', None)
+        self._debug = settings.DEBUG
+        self._subdomain_names = self.build_subdomain_names(_DEFAULT_SUBDOMAIN_NAMES)
+        self._urlconf_by_host, self._fallback_urlconf = self.build_urlconfs()
+        redirect_config = _lower_case_domains(self.redirect_config, 'MULTI_REDIRECT_CONFIG')
+        self._redirect_urls = {
+            domain: f'https://{redirect_domain}'
+            for domain, redirect_domain in redirect_config.items()
+            if redirect_domain
+        }
+        self._dispatch, self._fallback = self.build_dispatch()
+        self._domain_trie = _DomainTrie({*redirect_config, *self._urlconf_by_host})
+
     def __call__(self, request):
         """
         Handles the incoming request.
@@ -38,116 +202,180 @@ class MultipleDomainMiddleware:
         # Extract the domain name and subdomains from the request's host (excluding port if present).
         host_domain_name, subdomains = self.get_host_domain_and_subdomains(request)
 
-        # Check if there is a redirect configuration for the current domain.
-        if self.redirect_config:
-            redirect_domain = self.redirect_config.get(host_domain_name)
+        # Look up what to do with the current domain.
+        action, payload = self._dispatch.get(host_domain_name, self._fallback)
 
-            # If a redirect is configured for this domain, return an HTTP 301 response.
-            if redirect_domain:
-                return HttpResponsePermanentRedirect(f'https://{redirect_domain}')
+        # If a redirect is configured for this domain, return an HTTP 301 response.
+        if action == _REDIRECT:
+            return HttpResponsePermanentRedirect(payload)
+
+        # If no valid configuration is found, return a 404 Not Found response.
+        if action == _NOT_FOUND:
+            return HttpResponseNotFound()
 
         # Add subdomain information as attributes to the request object for later use.
         self.add_subdomains_to_request(request, subdomains)
 
-        # Process the request by determining the appropriate URL configuration.
-        if not self.process_request(request, host_domain_name):
-            # If no valid configuration is found, return a 404 Not Found response.
-            return HttpResponseNotFound()
+        # Assign the URL configuration for this domain to the request object.
+        request.urlconf = payload
 
-        # If processing is successful, proceed to the next middleware or view.
+        # Proceed to the next middleware or view.
         response = self.get_response(request)
         return response
 
     def get_host_domain_and_subdomains(self, request):
         """
-        Extracts the base domain and subdomains from the request's host using the Public Suffix List.
+        Extracts the base domain and subdomains from the request's host, matching configured
+        domains first and using the Public Suffix List for any other host.
         """
 
-        # Extract the host name from the request (excluding the port number, if present).
-        host = request.get_host().split(':')[0]
+        # Read the host straight from the request headers rather than through request.get_host(),
+        # which validates it against ALLOWED_HOSTS on every call. Django still performs that
+        # validation wherever the host is used to build URLs (e.g., CommonMiddleware).
+        meta = request.META
+        host = (
+            (self._use_x_forwarded_host and meta.get('HTTP_X_FORWARDED_HOST'))
+            or meta.get('HTTP_HOST')
+            or meta.get('SERVER_NAME', '')
+        )
 
-        # Get the second-level domain (SLD) using the public suffix list.
-        sld = get_sld(host)
+        return _parse_host(host, self._domain_trie)
 
-        if sld:
-            # Split the full host into parts (e.g., subdomain.domain.com -> [subdomain, domain, com]).
-            domain_parts = host.split('.')
-            sld_parts = sld.split('.')
+    def add_subdomains_to_request(self, request, subdomains):
+        """
+        Adds subdomain parameters to the request object as attributes.
+        """
+        param_names = self._subdomain_names
 
-            # Determine the subdomains by excluding the SLD parts from the full host.
-            subdomains = domain_parts[: -len(sld_parts)]
-        else:
-            # If get_sld fails, assume the entire host is the domain and there are no subdomains.
-            sld = host
-            subdomains = []
+        # If the host has more subdomains than the names prepared in advance, build the
+        # names for this request only, so the prepared names never grow with client input.
+        if len(subdomains) > len(param_names):
+            param_names = self.build_subdomain_names(len(subdomains))
 
-        # Return the base domain (SLD) and the list of subdomains.
-        return sld, subdomains
+        # Add the subdomains as attributes to the request object in a single update.
+        request.__dict__.update(zip(param_names, subdomains))
 
-    def add_subdomains_to_request(self, request, subdomains):
+    def build_subdomain_names(self, default_count):
         """
-        Adds subdomain parameters to the request object as attributes.
+        Returns the subdomain parameter names: the custom names from MULTI_SUBDOMAIN_CONFIG
+        followed by default_count default names (subdomain1, subdomain2, etc.), numbered
+        by their position.
+        """
+        custom_names = tuple(self.subdomain_config or ())
+        return custom_names + tuple(
+            f"subdomain{idx + 1}" for idx in range(len(custom_names), len(custom_names) + default_count)
+        )
+
+    def build_dispatch(self):
+        """
+        Combines the redirect and URL configurations into a single dispatch table.
+        Returns a mapping of domain to an (action, payload) pair and the pair used for
+        unrecognized domains.
         """
-        for idx, subdomain in enumerate(subdomains):
-            # Check if a custom name for the subdomain is defined in MULTI_SUBDOMAIN_CONFIG.
-            if self.subdomain_config and idx < len(self.subdomain_config):
-                param_name = self.subdomain_config[idx]
-            else:
-                # Default parameter name: subdomain1, subdomain2, etc.
-                param_name = f"subdomain{idx + 1}"
 
-            # Add the subdomain as an attribute to the request object.
-            setattr(request, param_name, subdomain)
+        # Domains with a URL configuration are routed with it.
+        dispatch = {
+            domain: (_URLCONF, urlconf)
+            for domain, urlconf in self._urlconf_by_host.items()
+            if urlconf is not None
+        }
+
+        # Redirects take precedence over URL configurations for the same domain.
+        dispatch.update(
+            (domain, (_REDIRECT, redirect_url))
+            for domain, redirect_url in self._redirect_urls.items()
+        )
+
+        # Unrecognized domains use the fallback configuration, or get a 404 if there is none.
+        if self._fallback_urlconf is None:
+            fallback = (_NOT_FOUND, None)
+        else:
+            fallback = (_URLCONF, self._fallback_urlconf)
+
+        return dispatch, fallback
 
-    def process_request(self, request, host_domain_name):
+    def build_urlconfs(self):
         """
-        Processes the incoming request by determining which URL configuration to apply.
-        It dynamically combines domain-specific URLs with common URLs (if defined in settings).
+        Builds the URL configuration for every domain in MULTI_DOMAIN_CONFIG, combining
+        domain-specific URLs with common URLs (if defined in settings).
+        Returns a mapping of domain to URL configuration and the configuration used for
+        unrecognized domains (or None if there is none).
         """
 
         # If MULTI_DOMAIN_CONFIG is not defined, domain-specific routing is not set up.
         if not self.url_config:
-            return False
+            return {}, None
 
-        # Check if common URLs are defined in settings (COMMON_URLS).
-        common_urls = getattr(settings, 'COMMON_URLS', None)
+        # Domain names are case-insensitive, so the configuration is keyed by lower-cased domains.
+        url_config = _lower_case_domains(self.url_config, 'MULTI_DOMAIN_CONFIG')
 
-        # Initialize an empty list to store the combined URL patterns.
-        combined_urlpatterns = []
+        # In DEBUG mode, use the default domain's configuration (if available) as a fallback.
+        default_urls_module = None
+        if self._debug and self._default_domain:
+            default_urls_module = url_config.get(self._default_domain.lower(), None)
 
-        # Get the URL configuration module specific to the current domain.
-        specific_urls_module = self.url_config.get(host_domain_name, None)
+        # Build a combined URL configuration for each configured domain. A domain configured
+        # without a URL module is treated like an unrecognized one and gets the fallback URLs.
+        urlconf_by_host = {
+            domain: self.build_urlconf(_urlconf_module_name(domain), urls_module or default_urls_module)
+            for domain, urls_module in url_config.items()
+        }
 
-        # If no specific URLs are found and the project is in DEBUG mode:
-        if not specific_urls_module and settings.DEBUG:
-            # Use the default domain's configuration (if available) as a fallback.
-            default_urls_module = self.url_config.get(settings.DEFAULT_DOMAIN, None)
-            if default_urls_module:
-                # Add the default domain's URL configuration to the combined URL patterns.
-                combined_urlpatterns.append(path('', include(default_urls_module)))
+        # Unrecognized domains get the default domain's URLs (DEBUG only) plus the common URLs.
+        fallback_urlconf = self.build_urlconf(_urlconf_module_name(), default_urls_module)
 
-        # If specific URLs for the current domain are defined, add them to the list.
-        if specific_urls_module:
-            # If common URLs are defined, add them to the combined URL patterns.
-            combined_urlpatterns.append(path('', include(specific_urls_module)))
+        return urlconf_by_host, fallback_urlconf
 
-        # If COMMON_URLS is defined, add it to the combined URL patterns as well.
-        if common_urls:
-            combined_urlpatterns.append(path('', include(common_urls)))
+    def build_urlconf(self, module_name, urls_module):
+        """
+        Creates a URL configuration module combining the given URL module with the common URLs
+        and registers it in sys.modules under module_name. Returns the module's name, which is
+        what gets assigned to request.urlconf, or None if there are no URL patterns to combine.
+        """
+
+        # If there are no URL modules to combine, there is nothing to route to.
+        if not urls_module and not self._common_urls:
+            return None
+
+        # The URL modules a combined configuration is built from, used to tell whether a module
+        # registered by an earlier instance of this middleware can be reused.
+        source = (urls_module, self._common_urls)
 
-        # If there are any URL patterns, create a temporary URL configuration module.
-        if combined_urlpatterns:
-            # Name the temporary module based on the domain or specific URL module.
-            module_name_base = specific_urls_module if specific_urls_module else host_domain_name
+        registered_module = sys.modules.get(module_name)
+        if registered_module is not None:
+            registered_source = getattr(registered_module, '_dj_multidomain_source', None)
+
+            # Never replace a module that was not registered by this middleware.
+            if registered_source is None:
+                raise ImproperlyConfigured(f"The module name '{module_name}' is already in use.")
+
+            # An identical configuration is already registered; keep it, along with any resolver
+            # Django has cached for it.
+            if registered_source == source:
+                return module_name
+
+        # Initialize an empty list to store the combined URL patterns.
+        combined_urlpatterns = []
+
+        # If a URL module is given, add it to the combined URL patterns.
+        if urls_module:
+            combined_urlpatterns.append(path('', include(urls_module)))
+
+        # If COMMON_URLS is defined, add it to the combined URL patterns as well.
+        if self._common_urls:
+            combined_urlpatterns.append(path('', include(self._common_urls)))
 
-            # Create a temporary URL configuration object with the combined patterns.
-            temp_urlconf_module = type(f"{module_name_base}_with_common", (object,), {
-                "urlpatterns": combined_urlpatterns
-            })
+        # Create a URL configuration module with the combined patterns and make it importable
+        # by name. Django's resolver cache is keyed on request.urlconf, so the stable name
+        # keeps it hitting on every request after the first.
+        urlconf_module = ModuleType(module_name)
+        urlconf_module.urlpatterns = combined_urlpatterns
+        urlconf_module._dj_multidomain_source = source
+        sys.modules[module_name] = urlconf_module
 
-            # Assign the temporary URL configuration to the request object.
-            request.urlconf = temp_urlconf_module
-            return True
+        # A different configuration was registered under this name before, so drop the
+        # resolver Django may have cached for it.
+        if registered_module is not None:
+            clear_url_caches()
 
-        # If no valid URL configuration was found, return False.
-        return False
+        return module_name